@@ -4,248 +4,692 @@ Test emails for azureSMTPwithOAuth.
 Sends various email formats including edge cases to verify relay functionality.
 
 Usage:
-    python3 test_emails.py <sender@domain.com> <recipient@domain.com> [host] [port]
+    python3 test_emails.py <sender@domain.com> <recipient@domain.com> [host] [port] [--rps N] [--workers N]
 
 Examples:
     python3 test_emails.py sender@example.com recipient@example.com
     python3 test_emails.py sender@example.com recipient@example.com 127.0.0.1 2526
+    python3 test_emails.py sender@example.com recipient@example.com --rps 2
 
 Requires a running azureSMTPwithOAuth instance with valid OAuth2 credentials
 and fallback_smtp_user/pass configured in config.yaml.
 """
 
+import argparse
 import smtplib
 import base64
+import binascii
+import collections
+import functools
+import logging
+import queue
+import re
+import select
+import socket
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Defaults (overridden by CLI args)
 SMTP_HOST = "127.0.0.1"
 SMTP_PORT = 2526
+SEND_RPS = 10
+WORKERS = 4
 
+log = logging.getLogger("smoketest")
 
-def send(label, msg_bytes, sender, recipient, host, port):
-    """Send a raw message and print result."""
-    try:
-        server = smtplib.SMTP(host, port, timeout=30)
-        server.ehlo()
-        server.login("", "")  # Uses fallback credentials from config
-        server.sendmail(sender, [recipient], msg_bytes)
-        server.quit()
-        print(f"  [OK] {label}")
-    except Exception as e:
-        print(f"  [FAIL] {label}: {e}")
 
+class BufferedHandler(logging.Handler):
+    """Collects formatted records and writes them to stream in one write per flush.
 
-def test1_plain_text(sender, recipient, host, port):
-    """Simple plain text email."""
-    msg = (
-        f"From: {sender}\r\n"
-        f"To: {recipient}\r\n"
-        f"Subject: [Test 1] Plain text email\r\n"
-        f"\r\n"
-        f"This is a simple plain text test email from azureSMTPwithOAuth.\r\n"
-        f"If you received this, basic email sending works correctly.\r\n"
-    )
-    send("Test 1 - Plain text", msg, sender, recipient, host, port)
+    Records at ERROR or above flush immediately.
+    """
+
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+        self.lines = []
 
+    def emit(self, record):
+        self.lines.append(self.format(record) + "\n")
+        if record.levelno >= logging.ERROR:
+            self.flush()
 
-def test2_html(sender, recipient, host, port):
+    def flush(self):
+        with self.lock:
+            if self.lines:
+                self.stream.write("".join(self.lines))
+                self.stream.flush()
+                self.lines.clear()
+
+
+def _b64_lines(data):
+    """Base64-encode data as CRLF-terminated lines of at most 76 chars (RFC 2045)."""
+    buf = bytearray()
+    for i in range(0, len(data), 57):
+        buf += binascii.b2a_base64(data[i:i + 57], newline=False)
+        buf += b"\r\n"
+    return bytes(buf)
+
+
+# Constant payloads, encoded once at import
+_TEST3_SUBJ = b"=?UTF-8?B?" + base64.b64encode(b"Test 3 - Unicode subject test") + b"?="
+_TEST3_BODY_B64 = base64.b64encode(b"Body with UTF-8 content encoded in base64.")
+_TEST5_FILE_B64 = _b64_lines(b"This is the content of the attached file.\nLine 2.\nLine 3.")
+_TEST9_LONG = (b"word " * 50).strip()  # 250 chars
+
+
+def _options(options):
+    """Format ESMTP parameters for a MAIL/RCPT command."""
+    return " " + " ".join(options) if options else ""
+
+
+_BARE_EOL = re.compile(rb"(?<!\r)\n|\r(?!\n)")
+
+
+def _dot_stuff(msg):
+    """Dot-stuff a message and append the DATA terminator (RFC 5321 4.5.2).
+
+    Line endings are normalised to CRLF first, so a bare-LF "." line cannot end
+    the DATA early. Accepts str like smtplib.SMTP.data() does.
+    """
+    if isinstance(msg, str):
+        msg = msg.encode("ascii")
+    msg = _BARE_EOL.sub(b"\r\n", msg)
+    q = msg.replace(b"\r\n.", b"\r\n..")
+    if q.startswith(b"."):
+        q = b"." + q
+    if not q.endswith(b"\r\n"):
+        q += b"\r\n"
+    return q + b".\r\n"
+
+
+class StuffedMessage(bytes):
+    """Message bytes that carry their dot-stuffed DATA form, computed once up front."""
+
+    def __new__(cls, msg):
+        self = super().__new__(cls, msg)
+        self.stuffed = _dot_stuff(msg)
+        return self
+
+
+def _data_payload(msg):
+    """DATA payload for msg, reusing the precomputed form when there is one."""
+    return msg.stuffed if isinstance(msg, StuffedMessage) else _dot_stuff(msg)
+
+
+class RelaySMTP(smtplib.SMTP):
+    """smtplib.SMTP that pipelines the envelope (RFC 2920) and sends the body
+    with BDAT (RFC 3030) when the server advertises those extensions."""
+
+    sndbuf = 256 * 1024  # Large enough to hand a whole message to the kernel in one sendall
+    pipeline_limit = 64 * 1024  # Unanswered bytes send_many() writes before reading replies
+
+    def connect(self, host="localhost", port=0, source_address=None):
+        code, msg = super().connect(host, port, source_address)
+        # Don't let Nagle hold back short command lines waiting for the previous reply
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        return code, msg
+
+    def sendmail(self, from_addr, to_addrs, msg, mail_options=(), rcpt_options=()):
+        self.ehlo_or_helo_if_needed()
+        if not self.has_extn("pipelining"):
+            return super().sendmail(from_addr, to_addrs, msg, mail_options, rcpt_options)
+        chunking = self.has_extn("chunking")
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        if isinstance(msg, str):
+            msg = _BARE_EOL.sub(b"\r\n", msg.encode("ascii"))
+
+        esmtp_opts = []
+        if self.has_extn("size"):
+            # Lets the server reject an oversized message at MAIL, before the body goes out
+            esmtp_opts.append(f"size={len(msg)}")
+        esmtp_opts.extend(mail_options)
+
+        # MAIL FROM, RCPT TO and DATA/BDAT go out in one write, replies are read in order
+        commands = [f"MAIL FROM:{smtplib.quoteaddr(from_addr)}{_options(esmtp_opts)}"]
+        commands += [f"RCPT TO:{smtplib.quoteaddr(addr)}{_options(rcpt_options)}" for addr in to_addrs]
+        commands.append(f"BDAT {len(msg)} LAST" if chunking else "DATA")
+        payload = "".join(f"{cmd}\r\n" for cmd in commands).encode("ascii")
+        if chunking:
+            # BDAT frames the body by length, so it is sent verbatim without dot-stuffing
+            payload += msg
+        self.send(payload)
+
+        mail_code, mail_resp = self.getreply()
+        senderrs = {}
+        for addr in to_addrs:
+            code, resp = self.getreply()
+            if code not in (250, 251):
+                senderrs[addr] = (code, resp)
+        data_code, data_resp = self.getreply()
+
+        if mail_code != 250 or len(senderrs) == len(to_addrs):
+            if data_code == 354 and not chunking:
+                # DATA was accepted despite the failed envelope, end it empty (RFC 2920 3.1)
+                self.send(b".\r\n")
+                self.getreply()
+            self._rset()
+            if mail_code != 250:
+                raise smtplib.SMTPSenderRefused(mail_code, mail_resp, from_addr)
+            raise smtplib.SMTPRecipientsRefused(senderrs)
+        if chunking:
+            self._check_data_reply(data_code, data_resp)
+            return senderrs
+        if data_code != 354:
+            self._rset()
+            raise smtplib.SMTPDataError(data_code, data_resp)
+
+        self.send(_data_payload(msg))
+        self._check_data_reply(*self.getreply())
+        return senderrs
+
+    def data(self, msg):
+        self.putcmd("data")
+        code, repl = self.getreply()
+        if code != 354:
+            raise smtplib.SMTPDataError(code, repl)
+        self.send(_data_payload(msg))
+        return self.getreply()
+
+    def send_many(self, envelopes, pacer=None):
+        """Send (from_addr, to_addrs, msg) transactions back to back.
+
+        Returns one result per envelope: None on success, otherwise the
+        SMTPException for that transaction. Envelopes cut off by a dropped
+        connection get SMTPServerDisconnected and are left for the caller to retry.
+        With PIPELINING and CHUNKING each RSET/MAIL/RCPT/BDAT group is written
+        without waiting for the previous replies; otherwise each envelope goes
+        through sendmail() in turn. If a pacer is given it is waited on before
+        every transaction and told about every result as its reply is read.
+        """
+        self.ehlo_or_helo_if_needed()
+        results = []
+
+        def record(result):
+            results.append(result)
+            if pacer is not None:
+                pacer.observe(result)
+
+        if not (self.has_extn("pipelining") and self.has_extn("chunking")):
+            for from_addr, to_addrs, msg in envelopes:
+                if pacer is not None:
+                    pacer.wait()
+                try:
+                    self.sendmail(from_addr, to_addrs, msg)
+                    record(None)
+                except smtplib.SMTPServerDisconnected as e:
+                    return results + [e] * (len(envelopes) - len(results))
+                except smtplib.SMTPException as e:
+                    record(e)
+            return results
+
+        pending = collections.deque()  # (from_addr, to_addrs, bytes written) awaiting replies
+        unread = 0
+
+        def drain_one():
+            nonlocal unread
+            from_addr, to_addrs, nbytes = pending.popleft()
+            unread -= nbytes
+            record(self._read_transaction(from_addr, to_addrs))
+
+        try:
+            for from_addr, to_addrs, msg in envelopes:
+                # Drain before writing more once pipeline_limit bytes are unanswered
+                # (RFC 2920 deadlock guard), or while the relay is pushing back so
+                # each reply can adjust the pace
+                if pending and (unread >= self.pipeline_limit or (pacer is not None and pacer.backing_off())):
+                    while pending:
+                        drain_one()
+                # Take in replies that have already arrived without waiting on any,
+                # so a 4xx can slow the next write
+                while pending and self._reply_ready():
+                    drain_one()
+                if pacer is not None:
+                    pacer.wait()
+                size = f" size={len(msg)}" if self.has_extn("size") else ""
+                commands = ["RSET", f"MAIL FROM:{smtplib.quoteaddr(from_addr)}{size}"]
+                commands += [f"RCPT TO:{smtplib.quoteaddr(addr)}" for addr in to_addrs]
+                commands.append(f"BDAT {len(msg)} LAST")
+                payload = "".join(f"{cmd}\r\n" for cmd in commands).encode("ascii") + msg
+                self.send(payload)
+                pending.append((from_addr, to_addrs, len(payload)))
+                unread += len(payload)
+            while pending:
+                drain_one()
+        except smtplib.SMTPServerDisconnected as e:
+            results += [e] * (len(envelopes) - len(results))
+        return results
+
+    def _reply_ready(self):
+        """True if reply bytes are already waiting on the socket."""
+        return bool(select.select([self.sock], [], [], 0)[0])
+
+    def _read_transaction(self, from_addr, to_addrs):
+        """Read the replies to one pipelined RSET/MAIL/RCPT/BDAT group."""
+        self.getreply()  # RSET
+        mail_code, mail_resp = self.getreply()
+        senderrs = {}
+        for addr in to_addrs:
+            code, resp = self.getreply()
+            if code not in (250, 251):
+                senderrs[addr] = (code, resp)
+        code, resp = self.getreply()  # BDAT
+        if mail_code != 250:
+            return smtplib.SMTPSenderRefused(mail_code, mail_resp, from_addr)
+        if len(senderrs) == len(to_addrs):
+            return smtplib.SMTPRecipientsRefused(senderrs)
+        if code != 250:
+            return smtplib.SMTPDataError(code, resp)
+        return None
+
+    def _check_data_reply(self, code, resp):
+        """Raise on a failed end-of-message reply, as smtplib.SMTP.data() does."""
+        if code != 250:
+            if code == 421:
+                self.close()
+            else:
+                self._rset()
+            raise smtplib.SMTPDataError(code, resp)
+
+
+def connect(host, port):
+    """Open an SMTP connection and authenticate once."""
+    server = RelaySMTP(host, port, timeout=30)
+    server.ehlo()
+    server.login("", "")  # Uses fallback credentials from config
+    return server
+
+
+class Pool:
+    """Fixed set of connected, authenticated SMTP connections shared by worker threads."""
+
+    def __init__(self, n, host, port):
+        self.host = host
+        self.port = port
+        self.q = queue.Queue()
+        try:
+            for _ in range(n):
+                self.q.put(self._mk())
+        except BaseException:
+            self.close()  # QUIT the connections opened before the failure
+            raise
+
+    def _mk(self):
+        return connect(self.host, self.port)
+
+    def acquire(self):
+        return self.q.get()
+
+    def release(self, conn):
+        self.q.put(conn)
+
+    def replace(self, conn):
+        """Return a freshly built connection in place of a broken one.
+
+        The new connection is built first; if that fails the broken one is
+        left as it is and the error propagates.
+        """
+        fresh = self._mk()
+        conn.close()
+        return fresh
+
+    def close(self):
+        while not self.q.empty():
+            conn = self.q.get_nowait()
+            try:
+                conn.quit()
+            except (smtplib.SMTPException, OSError):
+                conn.close()
+
+
+class Pacer:
+    """Spaces sends at least 1/rps seconds apart, across all worker threads.
+
+    A temporary (4xx) reply doubles the interval, up to max_interval, until the
+    next successful send.
+    """
+
+    max_interval = 2.0  # Seconds; keeps a rejecting relay from stalling the run
+
+    def __init__(self, rps):
+        self.base_interval = 1.0 / rps
+        self.min_interval = self.base_interval
+        self.last = 0.0
+        self.lock = threading.Lock()
+
+    def backing_off(self):
+        """True while a temporary reply has stretched the interval."""
+        with self.lock:
+            return self.min_interval > self.base_interval
+
+    def wait(self):
+        with self.lock:
+            dt = time.monotonic() - self.last
+            if dt < self.min_interval:
+                time.sleep(self.min_interval - dt)
+            self.last = time.monotonic()
+
+    def observe(self, result):
+        """Adjust the interval for a send result (None on success)."""
+        if result is None:
+            self.reset()
+        elif isinstance(result, smtplib.SMTPResponseException) and 400 <= result.smtp_code < 500:
+            self.backoff()  # Relay is pushing back, slow down
+
+    def backoff(self):
+        with self.lock:
+            self.min_interval = min(self.min_interval * 2, max(self.max_interval, self.base_interval))
+
+    def reset(self):
+        with self.lock:
+            self.min_interval = self.base_interval
+
+
+def send_batch(batch, sender, recipient, pool, pacer):
+    """Send (label, bytes) messages sharing one envelope over a pooled connection.
+
+    Returns a result line per message.
+    """
+    envelopes = [(sender, [recipient], msg_bytes) for _, msg_bytes in batch]
+    conn = pool.acquire()
+    try:
+        results = conn.send_many(envelopes, pacer)
+        # The relay closes the connection after some failures. Keep resending the
+        # envelopes cut off by a disconnect on fresh connections while each round
+        # gets at least one of them through to a real result.
+        while True:
+            retry = [i for i, r in enumerate(results) if isinstance(r, smtplib.SMTPServerDisconnected)]
+            if not retry:
+                break
+            try:
+                conn = pool.replace(conn)
+            except (smtplib.SMTPException, OSError):
+                break  # Report the remaining disconnects as they are
+            for i, result in zip(retry, conn.send_many([envelopes[i] for i in retry], pacer)):
+                results[i] = result
+            if all(isinstance(results[i], smtplib.SMTPServerDisconnected) for i in retry):
+                break  # No progress on a fresh connection, give up
+    finally:
+        pool.release(conn)
+
+    lines = []
+    for (label, _), result in zip(batch, results):
+        if result is None:
+            lines.append(f"  [OK] {label}")
+        else:
+            lines.append(f"  [FAIL] {label}: {result}")
+    return lines
+
+
+@functools.lru_cache(maxsize=1)
+def _addrs(sender, recipient):
+    """Substitution mapping for the message templates below.
+
+    Encoded once per run and shared by every builder. Addresses must be ASCII,
+    as the envelope commands are without SMTPUTF8.
+    """
+    return {b"sender": sender.encode("ascii"), b"recipient": recipient.encode("ascii")}
+
+
+_TEST1_TMPL = (
+    b"From: %(sender)s\r\n"
+    b"To: %(recipient)s\r\n"
+    b"Subject: [Test 1] Plain text email\r\n"
+    b"\r\n"
+    b"This is a simple plain text test email from azureSMTPwithOAuth.\r\n"
+    b"If you received this, basic email sending works correctly.\r\n"
+)
+
+
+def build_test1_plain_text(sender, recipient):
+    """Simple plain text email."""
+    return "Test 1 - Plain text", _TEST1_TMPL % _addrs(sender, recipient)
+
+
+_TEST2_TMPL = (
+    b"From: %(sender)s\r\n"
+    b"To: %(recipient)s\r\n"
+    b"Subject: [Test 2] HTML email\r\n"
+    b"Content-Type: text/html; charset=utf-8\r\n"
+    b"\r\n"
+    b"<html><body>"
+    b"<h2 style='color: #2e6da4;'>azureSMTPwithOAuth Test</h2>"
+    b"<p>This is an <strong>HTML</strong> email with:</p>"
+    b"<ul>"
+    b"<li>Bold text</li>"
+    b"<li>A list</li>"
+    b"<li>Special chars: &amp; &lt; &gt; &quot;</li>"
+    b"</ul>"
+    b"<p style='color: green;'>If you see this formatted, HTML rendering works.</p>"
+    b"</body></html>\r\n"
+)
+
+
+def build_test2_html(sender, recipient):
     """HTML email."""
-    msg = (
-        f"From: {sender}\r\n"
-        f"To: {recipient}\r\n"
-        f"Subject: [Test 2] HTML email\r\n"
-        f"Content-Type: text/html; charset=utf-8\r\n"
-        f"\r\n"
-        f"<html><body>"
-        f"<h2 style='color: #2e6da4;'>azureSMTPwithOAuth Test</h2>"
-        f"<p>This is an <strong>HTML</strong> email with:</p>"
-        f"<ul>"
-        f"<li>Bold text</li>"
-        f"<li>A list</li>"
-        f"<li>Special chars: &amp; &lt; &gt; &quot;</li>"
-        f"</ul>"
-        f"<p style='color: green;'>If you see this formatted, HTML rendering works.</p>"
-        f"</body></html>\r\n"
-    )
-    send("Test 2 - HTML", msg, sender, recipient, host, port)
+    return "Test 2 - HTML", _TEST2_TMPL % _addrs(sender, recipient)
 
 
-def test3_utf8_subject(sender, recipient, host, port):
-    """Email with RFC 2047 encoded subject (UTF-8)."""
-    subject_text = "Test 3 - Unicode subject test"
-    encoded_subject = "=?UTF-8?B?" + base64.b64encode(subject_text.encode("utf-8")).decode() + "?="
-    msg = (
-        f"From: {sender}\r\n"
-        f"To: {recipient}\r\n"
-        f"Subject: {encoded_subject}\r\n"
-        f"Content-Type: text/plain; charset=utf-8\r\n"
-        f"Content-Transfer-Encoding: base64\r\n"
-        f"\r\n"
-        + base64.b64encode("Body with UTF-8 content encoded in base64.".encode("utf-8")).decode()
-        + "\r\n"
-    )
-    send("Test 3 - UTF-8 encoded subject + base64 body", msg, sender, recipient, host, port)
+_TEST3_HEADERS_TMPL = (
+    b"From: %(sender)s\r\n"
+    b"To: %(recipient)s\r\n"
+    b"Subject: " + _TEST3_SUBJ + b"\r\n"
+    b"Content-Type: text/plain; charset=utf-8\r\n"
+    b"Content-Transfer-Encoding: base64\r\n"
+    b"\r\n"
+)
 
 
-def test4_multipart_alternative(sender, recipient, host, port):
+def build_test3_utf8_subject(sender, recipient):
+    """Email with RFC 2047 encoded subject (UTF-8)."""
+    headers = _TEST3_HEADERS_TMPL % _addrs(sender, recipient)
+    return "Test 3 - UTF-8 encoded subject + base64 body", b"".join([headers, _TEST3_BODY_B64, b"\r\n"])
+
+
+_TEST4_TMPL = (
+    b"From: %(sender)s\r\n"
+    b"To: %(recipient)s\r\n"
+    b"Subject: [Test 4] Multipart alternative\r\n"
+    b"MIME-Version: 1.0\r\n"
+    b"Content-Type: multipart/alternative; boundary=\"----=_Part_TEST4_BOUNDARY\"\r\n"
+    b"\r\n"
+    b"------=_Part_TEST4_BOUNDARY\r\n"
+    b"Content-Type: text/plain; charset=utf-8\r\n"
+    b"Content-Transfer-Encoding: 7bit\r\n"
+    b"\r\n"
+    b"This is the PLAIN TEXT version.\r\n"
+    b"You should NOT see this if your client supports HTML.\r\n"
+    b"\r\n"
+    b"------=_Part_TEST4_BOUNDARY\r\n"
+    b"Content-Type: text/html; charset=utf-8\r\n"
+    b"Content-Transfer-Encoding: 7bit\r\n"
+    b"\r\n"
+    b"<html><body><h3>Multipart Alternative Test</h3>"
+    b"<p>This is the <em>HTML version</em>. The relay should prefer this over plain text.</p>"
+    b"</body></html>\r\n"
+    b"\r\n"
+    b"------=_Part_TEST4_BOUNDARY--\r\n"
+)
+
+
+def build_test4_multipart_alternative(sender, recipient):
     """Multipart/alternative with both text and HTML parts."""
-    boundary = "----=_Part_TEST4_BOUNDARY"
-    msg = (
-        f"From: {sender}\r\n"
-        f"To: {recipient}\r\n"
-        f"Subject: [Test 4] Multipart alternative\r\n"
-        f"MIME-Version: 1.0\r\n"
-        f"Content-Type: multipart/alternative; boundary=\"{boundary}\"\r\n"
-        f"\r\n"
-        f"--{boundary}\r\n"
-        f"Content-Type: text/plain; charset=utf-8\r\n"
-        f"Content-Transfer-Encoding: 7bit\r\n"
-        f"\r\n"
-        f"This is the PLAIN TEXT version.\r\n"
-        f"You should NOT see this if your client supports HTML.\r\n"
-        f"\r\n"
-        f"--{boundary}\r\n"
-        f"Content-Type: text/html; charset=utf-8\r\n"
-        f"Content-Transfer-Encoding: 7bit\r\n"
-        f"\r\n"
-        f"<html><body><h3>Multipart Alternative Test</h3>"
-        f"<p>This is the <em>HTML version</em>. The relay should prefer this over plain text.</p>"
-        f"</body></html>\r\n"
-        f"\r\n"
-        f"--{boundary}--\r\n"
-    )
-    send("Test 4 - Multipart alternative (text+HTML)", msg, sender, recipient, host, port)
+    return "Test 4 - Multipart alternative (text+HTML)", _TEST4_TMPL % _addrs(sender, recipient)
+
+
+_TEST5_HEADERS_TMPL = (
+    b"From: %(sender)s\r\n"
+    b"To: %(recipient)s\r\n"
+    b"Subject: [Test 5] Email with attachment\r\n"
+    b"MIME-Version: 1.0\r\n"
+    b"Content-Type: multipart/mixed; boundary=\"----=_Part_TEST5_BOUNDARY\"\r\n"
+    b"\r\n"
+    b"------=_Part_TEST5_BOUNDARY\r\n"
+    b"Content-Type: text/plain; charset=utf-8\r\n"
+    b"Content-Transfer-Encoding: 7bit\r\n"
+    b"\r\n"
+    b"This email has a text file attachment (test_file.txt).\r\n"
+    b"\r\n"
+    b"------=_Part_TEST5_BOUNDARY\r\n"
+    b"Content-Type: text/plain; name=\"test_file.txt\"\r\n"
+    b"Content-Disposition: attachment; filename=\"test_file.txt\"\r\n"
+    b"Content-Transfer-Encoding: base64\r\n"
+    b"\r\n"
+)
+_TEST5_TAIL = b"\r\n------=_Part_TEST5_BOUNDARY--\r\n"
+
+
+def build_test5_attachment(sender, recipient):
+    """Email with a text file attachment."""
+    headers = _TEST5_HEADERS_TMPL % _addrs(sender, recipient)
+    return "Test 5 - Attachment", b"".join([headers, _TEST5_FILE_B64, _TEST5_TAIL])
 
 
-def test5_attachment(sender, recipient, host, port):
-    """Email with a text file attachment."""
-    boundary = "----=_Part_TEST5_BOUNDARY"
-    file_content = base64.b64encode(b"This is the content of the attached file.\nLine 2.\nLine 3.").decode()
-    msg = (
-        f"From: {sender}\r\n"
-        f"To: {recipient}\r\n"
-        f"Subject: [Test 5] Email with attachment\r\n"
-        f"MIME-Version: 1.0\r\n"
-        f"Content-Type: multipart/mixed; boundary=\"{boundary}\"\r\n"
-        f"\r\n"
-        f"--{boundary}\r\n"
-        f"Content-Type: text/plain; charset=utf-8\r\n"
-        f"Content-Transfer-Encoding: 7bit\r\n"
-        f"\r\n"
-        f"This email has a text file attachment (test_file.txt).\r\n"
-        f"\r\n"
-        f"--{boundary}\r\n"
-        f"Content-Type: text/plain; name=\"test_file.txt\"\r\n"
-        f"Content-Disposition: attachment; filename=\"test_file.txt\"\r\n"
-        f"Content-Transfer-Encoding: base64\r\n"
-        f"\r\n"
-        f"{file_content}\r\n"
-        f"\r\n"
-        f"--{boundary}--\r\n"
-    )
-    send("Test 5 - Attachment", msg, sender, recipient, host, port)
+_TEST6_TMPL = (
+    b"From: %(sender)s\r\n"
+    b"To: %(recipient)s\r\n"
+    b"Subject: [Test 6] Quoted-printable encoding\r\n"
+    b"Content-Type: text/plain; charset=utf-8\r\n"
+    b"Content-Transfer-Encoding: quoted-printable\r\n"
+    b"\r\n"
+    b"This email uses quoted-printable encoding.=0D=0A"
+    b"Special chars: =C3=A9=C3=A8=C3=AA (accented e variants)=0D=0A"
+    b"Long line that should be soft-wrapped with an equals sign at the end of =\r\n"
+    b"the line to test proper QP decoding.\r\n"
+)
 
 
-def test6_quoted_printable(sender, recipient, host, port):
+def build_test6_quoted_printable(sender, recipient):
     """Email with quoted-printable encoding (common in legacy systems)."""
-    msg = (
-        f"From: {sender}\r\n"
-        f"To: {recipient}\r\n"
-        f"Subject: [Test 6] Quoted-printable encoding\r\n"
-        f"Content-Type: text/plain; charset=utf-8\r\n"
-        f"Content-Transfer-Encoding: quoted-printable\r\n"
-        f"\r\n"
-        f"This email uses quoted-printable encoding.=0D=0A"
-        f"Special chars: =C3=A9=C3=A8=C3=AA (accented e variants)=0D=0A"
-        f"Long line that should be soft-wrapped with an equals sign at the end of =\r\n"
-        f"the line to test proper QP decoding.\r\n"
-    )
-    send("Test 6 - Quoted-printable", msg, sender, recipient, host, port)
+    return "Test 6 - Quoted-printable", _TEST6_TMPL % _addrs(sender, recipient)
+
+
+_TEST7_TMPL = (
+    b"From: %(sender)s\r\n"
+    b"To: %(recipient)s\r\n"
+    b"Cc: %(recipient)s\r\n"
+    b"Subject: [Test 7] CC header test\r\n"
+    b"\r\n"
+    b"This email has a CC header set to the same recipient.\r\n"
+    b"Tests that CC addresses are parsed and deduplicated from To recipients.\r\n"
+)
 
 
-def test7_cc_bcc(sender, recipient, host, port):
+def build_test7_cc_bcc(sender, recipient):
     """Email with CC header (tests CC/BCC parsing and deduplication)."""
-    msg = (
-        f"From: {sender}\r\n"
-        f"To: {recipient}\r\n"
-        f"Cc: {recipient}\r\n"
-        f"Subject: [Test 7] CC header test\r\n"
-        f"\r\n"
-        f"This email has a CC header set to the same recipient.\r\n"
-        f"Tests that CC addresses are parsed and deduplicated from To recipients.\r\n"
-    )
-    send("Test 7 - CC header", msg, sender, recipient, host, port)
+    return "Test 7 - CC header", _TEST7_TMPL % _addrs(sender, recipient)
+
+
+_TEST8_TMPL = (
+    b"From: %(sender)s\r\n"
+    b"To: %(recipient)s\r\n"
+    b"Subject: [Test 8] No Content-Type header\r\n"
+    b"\r\n"
+    b"This email has no Content-Type header at all.\r\n"
+    b"The relay should handle this gracefully and treat it as plain text.\r\n"
+)
 
 
-def test8_missing_content_type(sender, recipient, host, port):
+def build_test8_missing_content_type(sender, recipient):
     """Email with no Content-Type header (edge case - should default to text)."""
-    msg = (
-        f"From: {sender}\r\n"
-        f"To: {recipient}\r\n"
-        f"Subject: [Test 8] No Content-Type header\r\n"
-        f"\r\n"
-        f"This email has no Content-Type header at all.\r\n"
-        f"The relay should handle this gracefully and treat it as plain text.\r\n"
-    )
-    send("Test 8 - Missing Content-Type", msg, sender, recipient, host, port)
+    return "Test 8 - Missing Content-Type", _TEST8_TMPL % _addrs(sender, recipient)
+
 
+_TEST9_TMPL = (
+    b"From: %(sender)s\r\n"
+    b"To: %(recipient)s\r\n"
+    b"Subject: [Test 9] Long subject: " + _TEST9_LONG + b"\r\n"
+    b"\r\n"
+    b"This email has a very long subject line to test handling of oversized headers.\r\n"
+)
 
-def test9_long_subject(sender, recipient, host, port):
+
+def build_test9_long_subject(sender, recipient):
     """Email with a very long subject line."""
-    long_part = "word " * 50  # 250 chars
-    msg = (
-        f"From: {sender}\r\n"
-        f"To: {recipient}\r\n"
-        f"Subject: [Test 9] Long subject: {long_part.strip()}\r\n"
-        f"\r\n"
-        f"This email has a very long subject line to test handling of oversized headers.\r\n"
-    )
-    send("Test 9 - Long subject", msg, sender, recipient, host, port)
+    return "Test 9 - Long subject", _TEST9_TMPL % _addrs(sender, recipient)
+
+
+_TEST10_TMPL = (
+    b"From: %(sender)s\r\n"
+    b"To: %(recipient)s\r\n"
+    b"Subject: [Test 10] Empty body\r\n"
+    b"\r\n"
+)
 
 
-def test10_empty_body(sender, recipient, host, port):
+def build_test10_empty_body(sender, recipient):
     """Email with an empty body."""
-    msg = (
-        f"From: {sender}\r\n"
-        f"To: {recipient}\r\n"
-        f"Subject: [Test 10] Empty body\r\n"
-        f"\r\n"
-    )
-    send("Test 10 - Empty body", msg, sender, recipient, host, port)
+    return "Test 10 - Empty body", _TEST10_TMPL % _addrs(sender, recipient)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("Usage: python3 test_emails.py <sender@domain.com> <recipient@domain.com> [host] [port]")
-        print("Example: python3 test_emails.py sender@example.com recipient@example.com 127.0.0.1 2526")
-        sys.exit(1)
-
-    sender = sys.argv[1]
-    recipient = sys.argv[2]
-    host = sys.argv[3] if len(sys.argv) > 3 else SMTP_HOST
-    port = int(sys.argv[4]) if len(sys.argv) > 4 else SMTP_PORT
-
-    print(f"Sending test emails via {host}:{port}")
-    print(f"From: {sender} -> To: {recipient}\n")
-
-    tests = [
-        test1_plain_text,
-        test2_html,
-        test3_utf8_subject,
-        test4_multipart_alternative,
-        test5_attachment,
-        test6_quoted_printable,
-        test7_cc_bcc,
-        test8_missing_content_type,
-        test9_long_subject,
-        test10_empty_body,
+    parser = argparse.ArgumentParser(
+        description="Send test emails through azureSMTPwithOAuth.",
+        epilog="Example: python3 test_emails.py sender@example.com recipient@example.com 127.0.0.1 2526",
+    )
+    parser.add_argument("sender")
+    parser.add_argument("recipient")
+    parser.add_argument("host", nargs="?", default=SMTP_HOST)
+    parser.add_argument("port", nargs="?", type=int, default=SMTP_PORT)
+    parser.add_argument("--rps", type=float, default=SEND_RPS, help=f"max sends per second (default {SEND_RPS})")
+    parser.add_argument("--workers", type=int, default=WORKERS, help=f"parallel connections (default {WORKERS})")
+    args = parser.parse_args()
+    if args.rps <= 0:
+        parser.error("--rps must be positive")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if not (args.sender.isascii() and args.recipient.isascii()):
+        parser.error("sender and recipient must be ASCII addresses")
+
+    sender = args.sender
+    recipient = args.recipient
+    host = args.host
+    port = args.port
+    pacer = Pacer(args.rps)
+
+    handler = BufferedHandler(sys.stdout)
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+
+    log.info("Sending test emails via %s:%s", host, port)
+    log.info("From: %s -> To: %s\n", sender, recipient)
+
+    builders = [
+        build_test1_plain_text,
+        build_test2_html,
+        build_test3_utf8_subject,
+        build_test4_multipart_alternative,
+        build_test5_attachment,
+        build_test6_quoted_printable,
+        build_test7_cc_bcc,
+        build_test8_missing_content_type,
+        build_test9_long_subject,
+        build_test10_empty_body,
+    ]
+    # Dot-stuff each message once here, so retries reuse the same DATA payload
+    MESSAGES: list[tuple[str, bytes]] = [
+        (label, StuffedMessage(msg)) for label, msg in (build(sender, recipient) for build in builders)
     ]
 
-    for i, test_fn in enumerate(tests):
-        test_fn(sender, recipient, host, port)
-        if i < len(tests) - 1:
-            time.sleep(1)  # Small delay between sends
+    workers = min(args.workers, len(MESSAGES))
+    try:
+        pool = Pool(workers, host, port)
+    except Exception as e:
+        log.error("  [FAIL] Connect to %s:%s: %s", host, port, e)
+        sys.exit(1)
 
-    print(f"\nDone! Check {recipient} inbox.")
+    # Every message shares the (sender, [recipient]) envelope, so each worker
+    # sends an interleaved slice of them as one batch on its connection
+    batches = [MESSAGES[i::workers] for i in range(workers)]
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        batch_lines = list(ex.map(lambda b: send_batch(b, sender, recipient, pool, pacer), batches))
+    for i in range(len(MESSAGES)):
+        log.info("%s", batch_lines[i % workers][i // workers])
+    pool.close()
+
+    log.info("\nDone! Check %s inbox.", recipient)
+    handler.flush()